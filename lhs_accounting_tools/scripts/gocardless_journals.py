@@ -2,21 +2,21 @@ import os
 import click
 import gocardless_pro
 import pytz
-import csv
-from dateutil.parser import parse as parse_datetime
-from datetime import date, timedelta
+import calendar
+from datetime import date, datetime
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 
-def parse_date(date_str):
-    # Not using dateutil here as sometimes it thinks you've got an
-    # American date format when you haven't.
-    return date(*map(int, date_str.split("-")))
+def last_day_of_month(year, month):
+    return date(year, month, calendar.monthrange(year, month)[1])
 
 
-def last_day_of_month(year, month):
-    next_month = date(year, month, 28) + timedelta(days=4)
-    return next_month - timedelta(days=next_month.day)
+def csv_escape(value):
+    """Quote a CSV field if it contains characters which would otherwise break the row."""
+    if any(c in value for c in ',"\r\n'):
+        return '"' + value.replace('"', '""') + '"'
+    return value
 
 
 # Field names for Xero's manual journal import feature
@@ -39,6 +39,9 @@ MEMBERSHIP_ACCOUNT = "201"
 DONATIONS_ACCOUNT = "200"
 CLEARING_ACCOUNT = "GOCARDLESS"
 
+# Largest page size the GoCardless API will return from list endpoints
+PAGE_SIZE = 500
+
 
 @click.command()
 @click.option(
@@ -66,7 +69,9 @@ CLEARING_ACCOUNT = "GOCARDLESS"
     help="GoCardless API read only access token (can also be provided through the "
     "GOCARDLESS_ACCESS_TOKEN environment variable).",
 )
-@click.argument("output_csv", type=click.File("w"))
+@click.argument(
+    "output_csv", type=click.Path(dir_okay=False, writable=True, allow_dash=True)
+)
 def main(from_date, until_date, min_membership, access_token, output_csv):
     """
         Fetch transactions from the GoCardless API and emit a CSV file of
@@ -79,52 +84,43 @@ def main(from_date, until_date, min_membership, access_token, output_csv):
 
     payment_data = get_payment_data(gc, from_date, until_date)
 
-    csvfile = csv.writer(output_csv)
-    csvfile.writerow(CSV_FIELDS)
+    # All fields other than the narration are fixed strings or numbers, so rows are
+    # formatted directly rather than through the csv module. Lines end in \r\n to
+    # match csv.writer's output.
+    rows = []
     for row in generate_transactions(payment_data, min_membership):
-        row_prefix = [
-            f"GoCardless membership payments for {row['date'].year}-{row['date'].month}",
-            row["date"].isoformat(),
-        ]
-        continuation = ["", ""]
-        csvfile.writerow(
-            row_prefix
-            + [
-                "GoCardless",
-                CLEARING_ACCOUNT,
-                "No VAT",
-                (row["membership"] + row["donations"] - row["fees"]) / 100,
-            ]
-        )
-        csvfile.writerow(
-            continuation + ["GoCardless fees", FEES_ACCOUNT, "No VAT", row["fees"] / 100]
+        journal_date = row["date"]
+        narration = csv_escape(
+            f"GoCardless membership payments for {journal_date.year}-{journal_date.month}"
         )
-        csvfile.writerow(
-            continuation
-            + [
-                "GoCardless membership subscriptions",
-                MEMBERSHIP_ACCOUNT,
-                "No VAT",
-                -row["membership"] / 100,
+        fees, membership, donations = row["fees"], row["membership"], row["donations"]
+        rows.extend(
+            [
+                f"{narration},{journal_date.isoformat()},GoCardless,{CLEARING_ACCOUNT},"
+                f"No VAT,{(membership + donations - fees) / 100}\r\n",
+                f",,GoCardless fees,{FEES_ACCOUNT},No VAT,{fees / 100}\r\n",
+                f",,GoCardless membership subscriptions,{MEMBERSHIP_ACCOUNT},"
+                f"No VAT,{-membership / 100}\r\n",
+                f",,GoCardless membership donations,{DONATIONS_ACCOUNT},"
+                f"No VAT,{-donations / 100}\r\n",
             ]
         )
-        csvfile.writerow(
-            continuation
-            + ["GoCardless membership donations", DONATIONS_ACCOUNT, "No VAT", -row["donations"] / 100]
-        )
+
+    # Encode the whole file up front and write it in one go. The output is opened in
+    # binary mode so that "-" (stdout) gets the same UTF-8 bytes and line endings.
+    with click.open_file(output_csv, "wb") as f:
+        f.write((",".join(CSV_FIELDS) + "\r\n" + "".join(rows)).encode("utf-8"))
 
 
 def generate_transactions(data, min_membership):
+    threshold = min_membership * 100
     for (year, month), row in data.items():
-        fees_total = sum(row["fees"])
-        membership_total = 0
-        donation_total = 0
-        for amount in row["payments"]:
-            if amount < min_membership * 100:
-                donation_total += amount
-            else:
-                membership_total += min_membership * 100
-                donation_total += amount - (min_membership * 100)
+        fees_total = row["fees"]
+        # Each payment at or above the minimum contributes exactly the minimum
+        # to membership; everything else paid that month is a donation.
+        subscriptions = sum(1 for amount in row["payments"] if amount >= threshold)
+        membership_total = subscriptions * threshold
+        donation_total = sum(row["payments"]) - membership_total
         yield {
             "date": last_day_of_month(year, month),
             "fees": fees_total,
@@ -134,34 +130,49 @@ def generate_transactions(data, min_membership):
 
 
 def get_payment_data(gc, since_date, until_date):
-    data = defaultdict(lambda: {"fees": [], "payments": []})
+    data = defaultdict(lambda: {"fees": 0, "payments": []})
+
+    # Payments and payouts are independent listings, so fetch them concurrently.
+    # Each listing is still paged sequentially as the API paginates by cursor.
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        payments = executor.submit(
+            list,
+            gc.payments.all(
+                params={
+                    "charge_date[gte]": since_date.date().isoformat(),
+                    "charge_date[lte]": until_date.date().isoformat(),
+                    "limit": PAGE_SIZE,
+                }
+            ),
+        )
+        payouts = executor.submit(
+            list,
+            gc.payouts.all(
+                params={
+                    "created_at[gte]": since_date.isoformat(),
+                    "created_at[lte]": until_date.isoformat(),
+                    "limit": PAGE_SIZE,
+                }
+            ),
+        )
 
-    for payment in gc.payments.all(
-        params={
-            "charge_date[gte]": since_date.date().isoformat(),
-            "charge_date[lte]": until_date.date().isoformat(),
-        }
-    ):
+    for payment in payments.result():
         if payment.status not in ("confirmed", "paid_out"):
             continue
         assert payment.currency == "GBP"
 
-        charge_date = parse_date(payment.charge_date)
+        charge_date = date.fromisoformat(payment.charge_date)
 
         data[(charge_date.year, charge_date.month)]["payments"].append(payment.amount)
 
-    for payout in gc.payouts.all(
-        params={
-            "created_at[gte]": since_date.isoformat(),
-            "created_at[lte]": until_date.isoformat(),
-        }
-    ):
+    for payout in payouts.result():
         if payout.status not in ("paid"):
             continue
 
         assert payout.currency == "GBP"
-        created_at = parse_datetime(payout.created_at)
+        # GoCardless timestamps are ISO 8601 in UTC, e.g. "2021-01-01T12:00:00.000Z".
+        created_at = datetime.fromisoformat(payout.created_at.replace("Z", "+00:00"))
 
-        data[(created_at.year, created_at.month)]["fees"].append(payout.deducted_fees)
+        data[(created_at.year, created_at.month)]["fees"] += int(payout.deducted_fees)
 
     return data
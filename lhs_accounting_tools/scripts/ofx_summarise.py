@@ -10,10 +10,11 @@ from ofxtools.models import (
     STMTRS,
     BANKTRANLIST,
 )
+from ofxtools.models.base import Aggregate
 from ofxtools.Types import OFXTypeWarning
 from ofxtools.header import make_header
-from more_itertools import chunked
 from pathlib import Path
+from typing import Iterable
 from datetime import datetime
 import xml.etree.ElementTree as ET
 import click
@@ -24,6 +25,12 @@ import warnings
 # Suppress warning about OFX descriptions longer than the spec allows.
 warnings.filterwarnings("ignore", category=OFXTypeWarning)
 
+# Matches the membership reference used on subscription payments (e.g. "HS01234").
+SUB_RE = re.compile(r"H[S5] ?([O0-9]{4,})", re.I)
+
+# FITIDs below this are Barclays temporary transaction IDs.
+MIN_FITID = 200900000000000
+
 
 @click.command()
 @click.option(
@@ -69,65 +76,85 @@ def main(min_sub, max_output_size, since_date, input_ofx, output_dir):
     click.secho("Parsing...", fg="blue")
     parser = OFXTree()
     parser.parse(input_ofx)
-    ofx = parser.convert()
+    statements = parser.findall(".//STMTRS")
+    assert len(statements) == 1, "Unexpected number of statement entities"
+    # Only convert the parts of the statement we need, rather than the whole document.
+    bankacctfrom = Aggregate.from_etree(statements[0].find("BANKACCTFROM"))
+    ledgerbal = Aggregate.from_etree(statements[0].find("LEDGERBAL"))
     click.secho("Processing...", fg="blue")
-    assert len(ofx.statements) == 1, "Unexpected number of statement entities"
 
     files_written = 0
-    for chunk in chunked(
-        filter_date(
-            summarise_transactions(ofx.statements[0].banktranlist, min_sub), since_date
+    for chunk in iter_chunks(
+        summarise_transactions(
+            iter_transactions(statements[0].find("BANKTRANLIST")), min_sub
         ),
+        since_date,
         max_output_size,
     ):
-        chunk = list(chunk)
-        output_file = output_dir / chunk[0].dtposted.strftime("%Y-%m-%d.ofx")
-
-        out_ofx = generate_ofx(chunk, ofx)
-        et = out_ofx.to_etree()
-        with output_file.open("wb") as f:
-            f.write(str(make_header(version=220)).encode("utf-8"))
-            f.write(ET.tostring(et))
-
+        write_chunk(chunk, output_dir, bankacctfrom, ledgerbal)
         files_written += 1
     click.secho(
         f"Complete. Wrote {files_written} output file(s) to {output_dir}.", fg="blue"
     )
 
 
-def filter_date(transactions, since_date):
-    if since_date is None:
-        yield from transactions
-        return
+def write_chunk(chunk, output_dir, bankacctfrom, ledgerbal):
+    """Write a chunk of transactions to an OFX file in output_dir."""
+    output_file = output_dir / chunk[0].dtposted.strftime("%Y-%m-%d.ofx")
 
+    et = generate_ofx(chunk, bankacctfrom, ledgerbal)
+    # ElementTree.write() emits many small writes; buffer them into bulk writes.
+    with output_file.open("wb", buffering=1 << 20) as f:
+        f.write(str(make_header(version=220)).encode("utf-8"))
+        ET.ElementTree(et).write(f)
+
+
+def iter_transactions(banktranlist):
+    """
+    Convert the STMTTRN elements of a parsed BANKTRANLIST into ofxtools STMTTRN
+    objects. The whole document has already been parsed, so this saves
+    converting the rest of it rather than reducing memory use.
+    """
+    for elem in banktranlist.iterfind("STMTTRN"):
+        yield Aggregate.from_etree(elem)
+
+
+def iter_chunks(transactions, since_date, size):
+    """
+    Yield lists of at most size transactions, skipping any posted on or before
+    since_date.
+    """
+    chunk = []
     for t in transactions:
-        if t.dtposted <= since_date:
+        if since_date is not None and t.dtposted <= since_date:
             continue
-        yield t
+        chunk.append(t)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
 
 
-def summarise_transactions(transactions: list[STMTTRN], min_sub):
+def summarise_transactions(transactions: Iterable[STMTTRN], min_sub):
     """
-    Given a list of transactions (ofxtools STMTTRN objects), summarise them by
+    Given an iterable of transactions (ofxtools STMTTRN objects), summarise them by
     combining the subscription transactions together.
 
     Returns a generator yielding the resulting STMTTRN objects.
     """
     sub_sum = donate_sum = count = 0
-    last_date = None
+    last_date = last_month = None
     first_month_passed = False  # Whether we've seen at least a month of transactions
 
     for t in sorted(transactions, key=lambda t: t.dtposted):
-        if int(t.fitid) < 200900000000000:
+        if int(t.fitid) < MIN_FITID:
             # Barclays temporary transaction ID used for uncleared transactions
             # (maybe historical)
             continue
 
-        if (
-            last_date is not None
-            and last_date.month != t.dtposted.month
-            and sub_sum > 0
-        ):
+        month = (t.dtposted.year, t.dtposted.month)
+        if last_month is not None and last_month != month and sub_sum > 0:
             # Month end has passed - last_date is the last transaction from the previous month.
             # Check if we should generate a summary.
             if first_month_passed:
@@ -162,7 +189,7 @@ def summarise_transactions(transactions: list[STMTTRN], min_sub):
             first_month_passed = True
 
         amount = t.trnamt
-        if re.search(r"H[S5] ?([O0-9]{4,})", t.name, flags=re.I):
+        if SUB_RE.search(t.name):
             if amount >= min_sub:
                 sub_sum += min_sub
                 donate_sum += amount - min_sub
@@ -176,10 +203,11 @@ def summarise_transactions(transactions: list[STMTTRN], min_sub):
             yield t
 
         last_date = t.dtposted
+        last_month = month
 
 
-def generate_ofx(transactions, source_ofx):
-    """Generate the ofxtools OFX structure for the output files.
+def generate_ofx(transactions, bankacctfrom, ledgerbal):
+    """Generate the OFX element tree for the output files.
     This is all just annoying boilerplate.
     """
     status_ok = STATUS(code=0, severity="INFO")
@@ -195,10 +223,9 @@ def generate_ofx(transactions, source_ofx):
                 status=status_ok,
                 stmtrs=STMTRS(
                     curdef="GBP",
-                    bankacctfrom=source_ofx.statements[0].bankacctfrom,
-                    ledgerbal=source_ofx.statements[0].ledgerbal,
+                    bankacctfrom=bankacctfrom,
+                    ledgerbal=ledgerbal,
                     banktranlist=BANKTRANLIST(
-                        *transactions,
                         dtstart=transactions[0].dtposted,
                         dtend=transactions[-1].dtposted,
                     ),
@@ -207,7 +234,12 @@ def generate_ofx(transactions, source_ofx):
         ),
     )
 
-    return ofx
+    et = ofx.to_etree()
+    # Append the transactions to the converted tree directly rather than
+    # passing them all through the BANKTRANLIST aggregate.
+    et.find(".//BANKTRANLIST").extend(t.to_etree() for t in transactions)
+
+    return et
 
 
 if __name__ == "__main__":